@@ -16,9 +16,12 @@
 
 import fnmatch
 import threading
+import time
 import cgi
 import urllib
 import os
+import json
+import math
 import gobject
 
 try:
@@ -50,6 +53,80 @@ def my_base(path):
 	return '/'
     return base
 
+def parse_seek(text):
+    """Parse a relative seek offset, in seconds.
+
+    Raises ValueError if the text isn't a finite number.
+    """
+    rel = float(text)
+    if math.isinf(rel) or math.isnan(rel):
+	raise ValueError('Seek offset must be finite')
+    return rel
+
+# Main-loop priorities for RPC calls. Player controls go ahead of status
+# queries, so that a button press isn't stuck behind page rendering.
+PRIORITY_CONTROL = gobject.PRIORITY_HIGH_IDLE
+PRIORITY_STATUS = gobject.PRIORITY_DEFAULT_IDLE
+
+# Default time (in seconds) to wait for the main loop before giving up.
+RPC_TIMEOUT = 2.0
+
+class RPCTimeout(Exception):
+    """The GObject main loop didn't execute an RPC call in time."""
+    pass
+
+class MainLoopCall:
+    """A single function call scheduled in the GObject main loop.
+
+    This is a helper for GObjectRPC, which creates one of these for
+    each call. Do not use it directly.
+    """
+    def __init__(self, func, args, kwargs):
+	"""Prepare a call.
+
+	One event object is created for synchronization, and one lock
+	to decide between starting and cancelling the call.
+	"""
+	self.func = func
+	self.args = args
+	self.kwargs = kwargs
+	self.retval = None
+	self.exval = None
+	self.started = False
+	self.cancelled = False
+	self.lock = threading.Lock()
+	self.event = threading.Event()
+
+    def run(self):
+	"""Execute the call (in the GObject main loop).
+
+	If the call has been cancelled, the function is not executed at
+	all.
+	"""
+	with self.lock:
+	    if self.cancelled:
+		return False
+	    self.started = True
+
+	try:
+	    self.retval = self.func(*self.args, **self.kwargs)
+	except Exception as e:
+	    self.exval = e
+
+	self.event.set()
+	return False
+
+    def cancel(self):
+	"""Cancel the call, unless it has already started.
+
+	Returns True if the call was cancelled (and so will never be
+	executed).
+	"""
+	with self.lock:
+	    if not self.started:
+		self.cancelled = True
+	    return self.cancelled
+
 class GObjectRPC:
     """RPC service for GObject main loop.
 
@@ -58,6 +135,13 @@ class GObjectRPC:
     propagated as though the function were executed in the current
     thread.
 
+    Each call has a deadline. If the main loop doesn't get to the call
+    in time, RPCTimeout is raised, and the call is cancelled rather than
+    being executed late. A call which has already started when the
+    deadline passes is waited for, so RPCTimeout always means that the
+    function was not executed. Calls are also given a priority: see
+    PRIORITY_CONTROL and PRIORITY_STATUS.
+
     Example usage:
 
         # In a background thread...
@@ -66,55 +150,62 @@ class GObjectRPC:
 	# Equivalent to: r = func(a, b, c), except that func() executes
 	# in the GObject main loop
 	r = rpc(func, a, b, c)
+
+	# As above, but scheduled ahead of status queries
+	rpc.control(func, a, b, c)
     """
-    def __init__(self):
-	"""Constructor. One event object is created for synchronization."""
-	self.func = None
-	self.args = None
-	self.kwargs = None
-	self.retval = None
-	self.exval = None
-	self.event = threading.Event()
+    def __init__(self, timeout = RPC_TIMEOUT):
+	"""Constructor.
+
+	Calls will be given the specified timeout, in seconds. The
+	wait_time attribute accumulates the total time (in seconds)
+	spent waiting for the main loop. Callers may reset it at will.
+	"""
+	self.timeout = timeout
+	self.wait_time = 0.0
 
     def __call__(self, func, *args, **kwargs):
 	"""Execute the given function in the GObject main loop.
 
 	Any arguments passed are fed to the function. Execution is
 	synchronous: this method doesn't return until after the function
-	has finished executing.
+	has finished executing, or until the timeout expires without the
+	function having started (in which case RPCTimeout is raised).
 
 	The return value of this method is the return value of the
 	supplied function. If the function raises an exception, then it
 	will be caught in the GObject main loop and re-raised as though
 	it were raised from this method.
 
-	Note that attempting an RPC call from within the main loop will
-	result in a deadlock.
+	The call is made with PRIORITY_STATUS. Note that attempting an
+	RPC call from within the main loop will always time out.
 	"""
-	self.func = func
-	self.args = args
-	self.kwargs = kwargs
+	return self.call(PRIORITY_STATUS, self.timeout, func, args, kwargs)
 
-	self.event.clear()
-	gobject.idle_add(self._run)
-	self.event.wait()
+    def control(self, func, *args, **kwargs):
+	"""As for __call__(), but with PRIORITY_CONTROL."""
+	return self.call(PRIORITY_CONTROL, self.timeout, func, args, kwargs)
 
-	if self.exval:
-	    raise self.exval
+    def call(self, priority, timeout, func, args = (), kwargs = {}):
+	"""Execute a function with the given priority and timeout.
 
-	return self.retval
+	This is the general form of __call__() and control().
+	"""
+	start = time.time()
+	c = MainLoopCall(func, args, kwargs)
+	gobject.idle_add(c.run, priority = priority)
 
-    def _run(self):
-	"""Helper method, executed in the GObject main loop.
+	if not c.event.wait(timeout):
+	    if c.cancel():
+		self.wait_time += time.time() - start
+		raise RPCTimeout('Timed out waiting for main loop')
+	    c.event.wait()
 
-	Do not call this method directly.
-	"""
-	try:
-	    self.retval = self.func(*self.args, **self.kwargs)
-	    self.exval = None
-	except Exception as e:
-	    self.exval = e
-	self.event.set()
+	self.wait_time += time.time() - start
+	if c.exval:
+	    raise c.exval
+
+	return c.retval
 
 class StaticResponse:
     """WSGI responder which delivers a static object."""
@@ -143,6 +234,8 @@ forbidden = StaticResponse('text/plain', 'Forbidden',
 	code = '403 Forbidden')
 bad_request = StaticResponse('text/plain', 'Bad request',
 	code = '400 Bad Request')
+unavailable = StaticResponse('text/plain', 'Service unavailable',
+	code = '503 Service Unavailable', headers = [('Retry-After', '1')])
 dash_redirect = StaticResponse('text/plain', '',
 	code = '302 Found', headers = [('Location', '/')])
 
@@ -206,6 +299,64 @@ HTML_START = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
 
 HTML_END = "</div></body></html>"
 
+REMOTE_PATH = '/remote'
+
+# Dashboard enhancement: when WebSockets are available, player controls
+# are sent over the remote-control channel instead of following links,
+# and the page is updated in place from the state sent back.
+REMOTE_JS = r"""<script type="text/javascript">
+//<![CDATA[
+(function() {
+    if (!window.WebSocket)
+	return;
+
+    var ws = new WebSocket('ws://' + location.host + '/remote');
+    var commands = {fs: 1, play: 1, pause: 1, seek: 1, volume: 1};
+
+    ws.onopen = function() {
+	ws.send('state');
+    };
+
+    ws.onmessage = function(ev) {
+	var s = JSON.parse(ev.data);
+	if (s.volume === undefined)
+	    return;
+
+	var p = document.getElementById('playing');
+	var v = document.getElementById('volume').getElementsByTagName('a');
+
+	if (s.title === null)
+	    p.textContent = 'nothing';
+	else
+	    p.textContent = s.title + (s.paused ? ' (paused)' : '');
+
+	for (var i = 0; i < v.length; i++)
+	    v[i].textContent = i <= s.volume ? '#' : '-';
+    };
+
+    var links = document.getElementsByTagName('a');
+    for (var i = 0; i < links.length; i++) {
+	var m = links[i].getAttribute('href').match(
+	    /^\/action_(\w+)(?:\?\w+=(.*))?$/);
+
+	if (!m || !commands[m[1]])
+	    continue;
+
+	links[i].onclick = (function(cmd) {
+	    return function() {
+		if (ws.readyState != 1)
+		    return true;
+		ws.send(cmd);
+		return false;
+	    };
+	})(m[2] === undefined ? m[1] :
+	   m[1] + ' ' + decodeURIComponent(m[2]));
+    }
+})();
+//]]>
+</script>
+"""
+
 about_page = StaticResponse('text/html',
     HTML_START +
 """Anuweb (Totem web interface)<br />
@@ -232,6 +383,7 @@ class AnuApp:
 	self.config = config
 	self.rpc = GObjectRPC()
 	self.totem_obj = totem_obj
+	self.last_state = None
 	self.last_path = self.config['default_media_path']
 	self.handlers = {
 	    '/': self.root,
@@ -252,9 +404,26 @@ class AnuApp:
 	It's expected that this function will be called from outside the
 	UI thread -- an RPC service is used to invoke methods on the
 	Totem object where necessary.
+
+	If the main loop is too busy to answer an RPC call in time, the
+	request fails with 503 Service Unavailable.
+
+	If the server supplies an 'anuweb.stats' dictionary in the
+	environment, the time spent waiting on RPC calls is stored in it
+	as 'rpc_wait', for the benefit of the access log.
 	"""
-	return self.handlers.get(environ['PATH_INFO'],
-	    not_found)(environ, start_response)
+	self.rpc.wait_time = 0.0
+	try:
+	    r = self.handlers.get(environ['PATH_INFO'],
+		not_found)(environ, start_response)
+	except RPCTimeout:
+	    r = unavailable(environ, start_response)
+
+	stats = environ.get('anuweb.stats')
+	if stats is not None:
+	    stats['rpc_wait'] = self.rpc.wait_time
+
+	return r
 
     def is_allowed(self, path):
 	"""Is this a browser-accessible path?"""
@@ -273,21 +442,95 @@ class AnuApp:
 
 	return True
 
+    def prefetch(self):
+	"""Warm up caches for the first visit to the file browser.
+
+	The default media path is listed and each entry is examined,
+	just as browse() would do. This may be slow (e.g. on network
+	filesystems or spun-down disks), so it should be called from a
+	background thread. Errors are ignored.
+	"""
+	path = self.config['default_media_path']
+	try:
+	    for f in os.listdir(path):
+		os.path.isdir(os.path.join(path, f))
+	except OSError:
+	    pass
+
+    def player_state(self, rpc):
+	"""Query Totem for the player state, via the given RPC service.
+
+	Returns a dictionary giving the title of the current item (or
+	None), whether it's paused, and the volume level (from 0 to
+	VOLUME_STEPS).
+
+	If the main loop is too busy to answer, the last known state is
+	returned instead, with an extra "stale" key set. If there is no
+	last known state, RPCTimeout is raised.
+	"""
+	try:
+	    mrl = rpc(self.totem_obj.get_current_mrl)
+	    if mrl is None:
+		title = None
+		paused = False
+	    else:
+		title = urllib.unquote(os.path.basename(mrl))
+		paused = bool(rpc(self.totem_obj.is_paused))
+
+	    volume = int(round(rpc(self.totem_obj.get_volume) *
+			       VOLUME_STEPS))
+	except RPCTimeout:
+	    if self.last_state is None:
+		raise
+	    state = self.last_state.copy()
+	    state['stale'] = True
+	    return state
+
+	state = {
+	    'title': title,
+	    'paused': paused,
+	    'volume': volume
+	}
+	self.last_state = state
+	return state.copy()
+
+    def play_file(self, rpc, path):
+	"""Replace the playlist with the given file and play it.
+
+	The caller must check the path with is_allowed() first. Both
+	commands are sent in a single RPC call, so that a timeout can't
+	leave the playlist replaced but not playing.
+	"""
+	def replace_and_play(mrl):
+	    self.totem_obj.action_remote(totem.REMOTE_COMMAND_REPLACE, mrl)
+	    self.totem_obj.action_remote(totem.REMOTE_COMMAND_PLAY, mrl)
+
+	rpc.control(replace_and_play, 'file://' + urllib.quote(path))
+
+    def set_volume(self, rpc, level):
+	"""Set the volume level (clamped to 0 to VOLUME_STEPS)."""
+	if level < 0:
+	    level = 0
+	if level > VOLUME_STEPS:
+	    level = VOLUME_STEPS
+
+	rpc.control(self.totem_obj.action_volume, float(level) / VOLUME_STEPS)
+
     def root(self, environ, start_response):
 	"""Path: / (dashboard page)"""
 	out = []
 	out.append(HTML_START)
 
-	mrl = self.rpc(self.totem_obj.get_current_mrl)
+	state = self.player_state(self.rpc)
 
-	out.append('Currently playing: ')
-	if mrl is None:
+	out.append('Currently playing: <span id="playing">')
+	if state['title'] is None:
 	    out.append('nothing')
 	else:
-	    out.append(cgi.escape(urllib.unquote(os.path.basename(mrl))))
-	    if self.rpc(self.totem_obj.is_paused):
+	    out.append(cgi.escape(state['title']))
+	    if state['paused']:
 		out.append(' (paused)')
-	out.append('<br />')
+	out.append('</span><br />')
 
 	out.append('Player: ')
 	out.append('[<a href="/action_fs">Fullscreen</a>] ')
@@ -295,11 +538,10 @@ class AnuApp:
 	out.append('[<a href="/action_pause">Pause</a>] ')
 	out.append('<br />')
 
-	volume = int(round(self.rpc(self.totem_obj.get_volume) * VOLUME_STEPS))
-	out.append('Volume: <span class="volume">')
+	out.append('Volume: <span class="volume" id="volume">')
 	for i in xrange(0, VOLUME_STEPS + 1):
 	    out.append(' <a href="/action_volume?level=%d">' % i)
-	    if i <= volume:
+	    if i <= state['volume']:
 		out.append('#')
 	    else:
 		out.append('-')
@@ -319,6 +561,7 @@ class AnuApp:
 	out.append('[<a href="/about">About</a>] ')
 	out.append('<br />')
 
+	out.append(REMOTE_JS)
 	out.append(HTML_END)
 
 	start_response('200 OK',
@@ -397,11 +640,11 @@ class AnuApp:
 	"""Path: /action_seek?rel=<n> (seek forward/back)"""
 	try:
 	    d = cgi.parse_qs(environ['QUERY_STRING'])
-	    rel = float(d['rel'][0])
+	    rel = parse_seek(d['rel'][0])
 	except:
 	    return not_found(environ, start_response)
 
-	self.rpc(self.totem_obj.action_seek_relative, rel * 1000.0)
+	self.rpc.control(self.totem_obj.action_seek_relative, rel * 1000.0)
 	return dash_redirect(environ, start_response)
 
     def action_open(self, environ, start_response):
@@ -415,11 +658,7 @@ class AnuApp:
 	if not self.is_allowed(path):
 	    return forbidden(environ, start_response)
 
-	mrl = 'file://' + urllib.quote(path)
-	self.rpc(self.totem_obj.action_remote,
-		 totem.REMOTE_COMMAND_REPLACE, mrl)
-	self.rpc(self.totem_obj.action_remote,
-		 totem.REMOTE_COMMAND_PLAY, mrl)
+	self.play_file(self.rpc, path)
 	return dash_redirect(environ, start_response)
 
     def action_volume(self, environ, start_response):
@@ -430,27 +669,22 @@ class AnuApp:
 	except:
 	    return bad_request(environ, start_response)
 
-	if level < 0:
-	    level = 0
-	if level > VOLUME_STEPS:
-	    level = VOLUME_STEPS
-
-	self.rpc(self.totem_obj.action_volume, float(level) / VOLUME_STEPS)
+	self.set_volume(self.rpc, level)
 	return dash_redirect(environ, start_response)
 
     def action_play(self, environ, start_response):
 	"""Path: /action_play (resume playback)"""
-	self.rpc(self.totem_obj.action_play)
+	self.rpc.control(self.totem_obj.action_play)
 	return dash_redirect(environ, start_response)
 
     def action_pause(self, environ, start_response):
 	"""Path: /action_pause (pause playback)"""
-	self.rpc(self.totem_obj.action_pause)
+	self.rpc.control(self.totem_obj.action_pause)
 	return dash_redirect(environ, start_response)
 
     def action_fs(self, environ, start_response):
 	"""Path: /action_fs (toggle full-screen)"""
-	self.rpc(self.totem_obj.action_fullscreen_toggle)
+	self.rpc.control(self.totem_obj.action_fullscreen_toggle)
 	return dash_redirect(environ, start_response)
 
     def action_ss_reset(self, environ, start_response):
@@ -458,3 +692,107 @@ class AnuApp:
 	os.system("xset dpms force on")
 	os.system("xdg-screensaver reset")
 	return dash_redirect(environ, start_response)
+
+class RemoteControl:
+    """Command interpreter for the remote-control channel.
+
+    One of these is created for each WebSocket connection. Connections
+    are served from their own threads, so each has its own RPC service.
+
+    Commands are short text messages:
+
+	state               (do nothing; just report state)
+	play
+	pause
+	fs                  (toggle full-screen)
+	seek <seconds>      (relative)
+	volume <level>      (0 to VOLUME_STEPS)
+	open <path>
+
+    Every command is answered with a JSON object describing the player
+    state, as returned by AnuApp.player_state(). If the command failed,
+    the object also contains an "error" key. If the state can't be
+    obtained (e.g. the main loop is too busy), only the "error" key is
+    present. Errors never close the connection.
+    """
+    def __init__(self, app):
+	"""Create an interpreter controlling the given AnuApp."""
+	self.app = app
+	self.rpc = GObjectRPC()
+	self.commands = {
+	    'state': self.cmd_state,
+	    'play': self.cmd_play,
+	    'pause': self.cmd_pause,
+	    'fs': self.cmd_fs,
+	    'seek': self.cmd_seek,
+	    'volume': self.cmd_volume,
+	    'open': self.cmd_open
+	}
+
+    def __call__(self, text):
+	"""Execute a command and return the JSON-encoded reply."""
+	words = text.split(' ', 1)
+	if len(words) > 1:
+	    arg = words[1]
+	else:
+	    arg = ''
+
+	error = None
+	cmd = self.commands.get(words[0])
+	if cmd is None:
+	    error = 'Unknown command'
+	else:
+	    try:
+		error = cmd(arg)
+	    except ValueError:
+		error = 'Bad request'
+	    except RPCTimeout:
+		error = 'Timed out'
+	    except Exception as e:
+		error = 'Failed: %s' % e
+
+	try:
+	    state = self.app.player_state(self.rpc)
+	except RPCTimeout:
+	    return json.dumps({'error': 'Timed out'})
+	except Exception as e:
+	    return json.dumps({'error': 'Failed: %s' % e})
+
+	if state['title'] is not None:
+	    state['title'] = state['title'].decode('utf-8', 'replace')
+	if error is not None:
+	    state['error'] = error
+
+	return json.dumps(state)
+
+    def cmd_state(self, arg):
+	"""Command: state"""
+	pass
+
+    def cmd_play(self, arg):
+	"""Command: play"""
+	self.rpc.control(self.app.totem_obj.action_play)
+
+    def cmd_pause(self, arg):
+	"""Command: pause"""
+	self.rpc.control(self.app.totem_obj.action_pause)
+
+    def cmd_fs(self, arg):
+	"""Command: fs"""
+	self.rpc.control(self.app.totem_obj.action_fullscreen_toggle)
+
+    def cmd_seek(self, arg):
+	"""Command: seek <seconds>"""
+	self.rpc.control(self.app.totem_obj.action_seek_relative,
+			 parse_seek(arg) * 1000.0)
+
+    def cmd_volume(self, arg):
+	"""Command: volume <level>"""
+	self.app.set_volume(self.rpc, int(arg))
+
+    def cmd_open(self, arg):
+	"""Command: open <path>"""
+	if not arg or not self.app.is_allowed(arg):
+	    return 'Forbidden'
+
+	self.app.play_file(self.rpc, arg)
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# Anuweb - Totem web interface
+# Copyright (C) 2013 Daniel Beer
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import gconf
+
+GCONF_KEY = '/apps/totem/plugins/anuweb'
+
+def read_config():
+    """Load configuration dictionary from GConf.
+
+    All known keys are loaded from GCONF_KEY. Defaults are substituted
+    for missing values.
+    """
+
+    def default(v, d):
+	if v is None:
+	    return d
+	return v
+
+    def get_int(key, d):
+	# get_int() returns 0 for a missing key, which is a valid
+	# setting for some keys. Check for the key's presence first.
+	v = g.get(key)
+	if v is None:
+	    return d
+	return v.get_int()
+
+    g = gconf.client_get_default()
+    return {
+	'server_port':
+	    default(g.get_int(GCONF_KEY + '/server_port'), 8099),
+	'default_media_path':
+	    default(g.get_string(GCONF_KEY + '/default_media_path'), '/'),
+	'filter_pattern':
+	    default(g.get_string(GCONF_KEY + '/filter_pattern'),
+		    '*.m??;*.avi;*.og?'),
+	'path_restrict':
+	    default(g.get_string(GCONF_KEY + '/path_restrict'), '/'),
+	'log_path':
+	    default(g.get_string(GCONF_KEY + '/log_path'), ''),
+	'log_sample_percent':
+	    get_int(GCONF_KEY + '/log_sample_percent', 100)
+    }
+
+class ConfigDialog:
+    """Plugin configuration dialog."""
+    def __init__(self, save_cb = None):
+	"""Construct the configuration dialog.
+
+	You can optionally supply a function object to be invoked when
+	the configuration is changed in GConf.
+	"""
+	# GTK+ is only needed once the dialog is opened, so it isn't
+	# imported when the plugin merely reads its configuration.
+	import gtk
+
+	PADDING = 10
+
+	self.save_cb = save_cb
+	self.dialog = gtk.Dialog("Anuweb", None,
+		gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+		(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT,
+		 gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+	tab = gtk.Table(6, 2)
+
+	label = gtk.Label("Server port:")
+	label.set_alignment(0.0, 0.5)
+	tab.attach(label, 0, 1, 0, 1, xoptions = gtk.FILL,
+		xpadding = PADDING, ypadding = PADDING)
+
+	self.server_port = gtk.SpinButton()
+	self.server_port.set_range(1, 65535)
+	self.server_port.set_increments(1, 1024)
+	self.server_port.set_digits(0)
+	tab.attach(self.server_port, 1, 2, 0, 1,
+		xpadding = PADDING, ypadding = PADDING)
+
+	label = gtk.Label("Default media path:")
+	label.set_alignment(0.0, 0.5)
+	tab.attach(label, 0, 1, 1, 2, xoptions = gtk.FILL,
+		xpadding = PADDING, ypadding = PADDING)
+
+	self.media_path = gtk.FileChooserButton("Default media path")
+	self.media_path.set_action(gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER)
+	self.media_path.set_size_request(250, -1)
+	tab.attach(self.media_path, 1, 2, 1, 2,
+		xpadding = PADDING, ypadding = PADDING)
+
+	label = gtk.Label("Browser root:")
+	label.set_alignment(0.0, 0.5)
+	tab.attach(label, 0, 1, 2, 3, xoptions = gtk.FILL,
+		xpadding = PADDING, ypadding = PADDING)
+
+	self.path_restrict = gtk.FileChooserButton("Browser root")
+	self.path_restrict.set_action(gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER)
+	self.path_restrict.set_size_request(250, -1)
+	tab.attach(self.path_restrict, 1, 2, 2, 3,
+		xpadding = PADDING, ypadding = PADDING)
+
+	label = gtk.Label("File filter pattern (glob):")
+	label.set_alignment(0.0, 0.5)
+	tab.attach(label, 0, 1, 3, 4, xoptions = gtk.FILL,
+		xpadding = PADDING, ypadding = PADDING)
+
+	self.filter_pattern = gtk.Entry()
+	tab.attach(self.filter_pattern, 1, 2, 3, 4,
+		xpadding = PADDING, ypadding = PADDING)
+
+	label = gtk.Label("Access log file (blank for stderr):")
+	label.set_alignment(0.0, 0.5)
+	tab.attach(label, 0, 1, 4, 5, xoptions = gtk.FILL,
+		xpadding = PADDING, ypadding = PADDING)
+
+	self.log_path = gtk.Entry()
+	tab.attach(self.log_path, 1, 2, 4, 5,
+		xpadding = PADDING, ypadding = PADDING)
+
+	label = gtk.Label("Access log sample rate (%):")
+	label.set_alignment(0.0, 0.5)
+	tab.attach(label, 0, 1, 5, 6, xoptions = gtk.FILL,
+		xpadding = PADDING, ypadding = PADDING)
+
+	self.log_sample_percent = gtk.SpinButton()
+	self.log_sample_percent.set_range(0, 100)
+	self.log_sample_percent.set_increments(1, 10)
+	self.log_sample_percent.set_digits(0)
+	tab.attach(self.log_sample_percent, 1, 2, 5, 6,
+		xpadding = PADDING, ypadding = PADDING)
+
+	tab.show_all()
+	self.dialog.vbox.pack_start(tab)
+
+	self.dialog.connect('response', self.dialog_response)
+	self.dialog.connect('show', self.dialog_show)
+
+    def get_dialog(self):
+	"""Obtain the actual GTK+ widget for the dialog."""
+	return self.dialog
+
+    def dialog_show(self, dialog):
+	"""Hook to be run when the dialog is shown.
+
+	This hook loads the configuration (or defaults) from GConf and
+	populates the dialog box's widgets.
+	"""
+	cfg = read_config()
+	self.server_port.set_value(cfg['server_port'])
+	self.media_path.set_filename(cfg['default_media_path'])
+	self.path_restrict.set_filename(cfg['path_restrict'])
+	self.filter_pattern.set_text(cfg['filter_pattern'])
+	self.log_path.set_text(cfg['log_path'])
+	self.log_sample_percent.set_value(cfg['log_sample_percent'])
+
+    def dialog_response(self, dialog, response_id):
+	"""Hook to be run when the dialog box is closed.
+
+	This hook checks the user's response, and if OK was clicked,
+	calls self.save_settings().
+	"""
+	import gtk
+
+	if response_id == gtk.RESPONSE_ACCEPT:
+	    self.save_settings()
+
+	self.dialog.hide()
+
+    def save_settings(self):
+	"""Write settings to GConf.
+
+	If a save_cb hook was supplied, it will be invoked after saving
+	the settings.
+	"""
+	g = gconf.client_get_default()
+	g.set_int(GCONF_KEY + '/server_port',
+		self.server_port.get_value_as_int())
+	g.set_string(GCONF_KEY + '/default_media_path',
+		self.media_path.get_filename())
+	g.set_string(GCONF_KEY + '/path_restrict',
+		self.path_restrict.get_filename())
+	g.set_string(GCONF_KEY + '/filter_pattern',
+		self.filter_pattern.get_text())
+	g.set_string(GCONF_KEY + '/log_path',
+		self.log_path.get_text())
+	g.set_int(GCONF_KEY + '/log_sample_percent',
+		self.log_sample_percent.get_value_as_int())
+
+	if self.save_cb is not None:
+	    self.save_cb()
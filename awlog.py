@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# Anuweb - Totem web interface
+# Copyright (C) 2013 Daniel Beer
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import sys
+import os
+import time
+import json
+import random
+import threading
+
+class RingBuffer:
+    """Fixed-size single-producer, single-consumer queue.
+
+    Exactly one thread may call put(), and exactly one (other) thread
+    may call get(). No locks are taken: the producer only ever writes
+    the head index and the consumer only ever writes the tail index,
+    and each index is published only after its slot has been written
+    or cleared.
+
+    One slot is always left empty so that a full buffer can be told
+    apart from an empty one.
+    """
+    def __init__(self, size):
+	"""Create a buffer able to hold (size - 1) items."""
+	self.slots = [None] * size
+	self.head = 0
+	self.tail = 0
+	self.dropped = 0
+
+    def put(self, item):
+	"""Append an item (producer only).
+
+	If the buffer is full, the item is discarded, the dropped
+	counter is incremented and False is returned.
+	"""
+	h = self.head
+	n = (h + 1) % len(self.slots)
+	if n == self.tail:
+	    self.dropped += 1
+	    return False
+
+	self.slots[h] = item
+	self.head = n
+	return True
+
+    def get(self):
+	"""Remove and return the oldest item (consumer only).
+
+	Returns None if the buffer is empty.
+	"""
+	t = self.tail
+	if t == self.head:
+	    return None
+
+	item = self.slots[t]
+	self.slots[t] = None
+	self.tail = (t + 1) % len(self.slots)
+	return item
+
+class AccessLog(threading.Thread):
+    """Buffered JSON-lines access log.
+
+    Records are queued by the server thread and written out in batches
+    by this background thread, so that a slow log destination never
+    holds up a request. Each record is written as a single line of
+    JSON.
+
+    If the buffer fills up before the writer catches up, new records
+    are dropped. The number of dropped records is reported in the log
+    the next time the writer runs.
+
+    Example usage:
+
+	log = AccessLog('/tmp/anuweb.log')
+	log.start()
+
+	# From the (single) server thread...
+	log.request('GET', '/', 200, 1234, 0.005, 0.002)
+
+	log.close()
+    """
+    def __init__(self, path = '', sample_percent = 100,
+		 max_bytes = 1024 * 1024, backup_count = 3,
+		 buffer_size = 1024, flush_interval = 0.5):
+	"""Initialize the log.
+
+	If a path is given, records are appended to that file, which is
+	rotated once it grows beyond max_bytes (keeping backup_count
+	old files named path.1, path.2, etc.). Otherwise, records go to
+	stderr and are never rotated.
+
+	Only sample_percent percent of successful requests are logged.
+	Errors (status 400 and above) and messages are always logged.
+
+	The thread isn't started until you call start().
+	"""
+	threading.Thread.__init__(self)
+	self.daemon = True
+	self.path = path
+	self.sample_percent = sample_percent
+	self.max_bytes = max_bytes
+	self.backup_count = backup_count
+	self.flush_interval = flush_interval
+	self.ring = RingBuffer(buffer_size)
+	self.stop_event = threading.Event()
+	self.reported_dropped = 0
+	self.stream = None
+
+    def request(self, method, route, status, size, latency, rpc_wait,
+		client = None):
+	"""Queue a record for a completed request.
+
+	Latency and RPC wait time are given in seconds. The method and
+	route come straight from the request line, so they may be any
+	bytes at all: they're decoded here, with invalid UTF-8 replaced.
+	This method never blocks.
+	"""
+	if status < 400 and random.random() * 100 >= self.sample_percent:
+	    return
+
+	self.ring.put({
+	    'time': time_now(),
+	    'client': client,
+	    'method': to_text(method),
+	    'route': to_text(route),
+	    'status': status,
+	    'bytes': size,
+	    'latency_ms': round(latency * 1000.0, 3),
+	    'rpc_wait_ms': round(rpc_wait * 1000.0, 3)
+	})
+
+    def message(self, text, client = None):
+	"""Queue a free-form message (never sampled, never blocks)."""
+	self.ring.put({
+	    'time': time_now(),
+	    'client': client,
+	    'message': to_text(text)
+	})
+
+    def run(self):
+	"""Worker function.
+
+	Do not call this method -- it's what runs in the created thread.
+	"""
+	while not self.stop_event.is_set():
+	    self.stop_event.wait(self.flush_interval)
+	    self.flush()
+
+	if self.stream is not None and self.stream is not sys.stderr:
+	    self.stream.close()
+	self.stream = None
+
+    def close(self):
+	"""Asynchronous shutdown.
+
+	Tell the writer thread to write any remaining records, close the
+	log file and exit. This method doesn't wait for it to do so,
+	since the log destination might be slow. If the process exits
+	first, the remaining records are lost.
+	"""
+	self.stop_event.set()
+
+    def open_stream(self):
+	"""Open the log destination."""
+	if self.path:
+	    self.stream = open(self.path, 'a')
+	else:
+	    self.stream = sys.stderr
+
+    def flush(self):
+	"""Write out all queued records.
+
+	Helper method, executed in the writer thread. Write errors are
+	ignored: the records in question are lost. A record which can't
+	be serialized is skipped and counted as dropped.
+	"""
+	lines = []
+	bad = 0
+
+	while True:
+	    r = self.ring.get()
+	    if r is None:
+		break
+	    try:
+		lines.append(json.dumps(r))
+	    except Exception:
+		bad += 1
+
+	dropped = self.ring.dropped
+	if bad or dropped != self.reported_dropped:
+	    lines.insert(0, json.dumps({
+		'time': time_now(),
+		'dropped': dropped - self.reported_dropped + bad
+	    }))
+	    self.reported_dropped = dropped
+
+	if not lines:
+	    return
+
+	try:
+	    if self.stream is None:
+		self.open_stream()
+	    self.stream.write('\n'.join(lines) + '\n')
+	    self.stream.flush()
+	    if self.path and self.stream.tell() >= self.max_bytes:
+		self.rotate()
+	except (IOError, OSError):
+	    pass
+
+    def rotate(self):
+	"""Rotate log files.
+
+	The current file becomes path.1, path.1 becomes path.2, and so
+	on. The oldest file is discarded.
+	"""
+	self.stream.close()
+	self.stream = None
+
+	for i in xrange(self.backup_count - 1, 0, -1):
+	    src = '%s.%d' % (self.path, i)
+	    if os.path.exists(src):
+		os.rename(src, '%s.%d' % (self.path, i + 1))
+
+	if self.backup_count > 0:
+	    os.rename(self.path, self.path + '.1')
+	else:
+	    os.remove(self.path)
+
+	self.open_stream()
+
+def to_text(s):
+    """Decode a byte string for logging, replacing invalid UTF-8."""
+    if isinstance(s, str):
+	return s.decode('utf-8', 'replace')
+    return s
+
+def time_now():
+    """Current time, as a timestamp suitable for log records."""
+    return round(time.time(), 3)
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# Anuweb - Totem web interface
+# Copyright (C) 2013 Daniel Beer
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+import time
+import anuweb
+import awlog
+import awsocket
+from wsgiref import simple_server
+
+class NoDNSHandler(simple_server.WSGIRequestHandler):
+    """Variant of the default WSGI request handler that avoids DNS.
+
+    We don't need hostnames in the logs, and reverse DNS generally takes
+    a long time to fail, blocking requests for an unbearable length of
+    time.
+
+    Logging is also redirected: rather than writing to stderr from the
+    server thread, records are queued on the server's access_log (an
+    awlog.AccessLog) and written out in the background.
+
+    WebSocket upgrade requests for the remote-control channel are
+    diverted before they reach the WSGI application.
+    """
+    def address_string(self):
+	"""Override that avoids reverse DNS.
+
+	This method is supposed to return the client's hostname.
+	Instead, we just return the IP address as a string.
+	"""
+	return self.client_address[0]
+
+    def handle(self):
+	"""Handle a single request, noting the time at which it began."""
+	self.start_time = time.time()
+	self.stats = {}
+	simple_server.WSGIRequestHandler.handle(self)
+
+    def parse_request(self):
+	"""Parse the request, diverting WebSocket upgrades.
+
+	Requests for the remote-control channel are answered here, and
+	False is returned to tell WSGIRequestHandler.handle() that the
+	request has already been dealt with.
+	"""
+	if not simple_server.WSGIRequestHandler.parse_request(self):
+	    return False
+	if self.path.split('?', 1)[0] != anuweb.REMOTE_PATH:
+	    return True
+
+	key = awsocket.handshake_key(self.command, self.headers)
+	if key is None:
+	    self.send_error(400)
+	    return False
+	if not awsocket.origin_allowed(self.headers):
+	    self.send_error(403)
+	    return False
+
+	# Clients may not send frames until they've seen our response,
+	# so nothing is left behind in self.rfile's buffer.
+	self.wfile.write(awsocket.handshake_response(key))
+	self.wfile.flush()
+	self.log_request(101, 0)
+	self.server.start_session(self.request,
+		anuweb.RemoteControl(self.server.get_app()))
+	return False
+
+    def get_environ(self):
+	"""Build the WSGI environment.
+
+	The application can report per-request statistics back to us
+	via the 'anuweb.stats' dictionary.
+	"""
+	env = simple_server.WSGIRequestHandler.get_environ(self)
+	env['anuweb.stats'] = self.stats
+	return env
+
+    def log_request(self, code = '-', size = '-'):
+	"""Queue a structured record for the completed request."""
+	try:
+	    status = int(code)
+	except ValueError:
+	    status = 0
+	try:
+	    size = int(size)
+	except ValueError:
+	    size = 0
+
+	self.server.access_log.request(
+	    getattr(self, 'command', ''),
+	    getattr(self, 'path', '').split('?', 1)[0],
+	    status, size, time.time() - self.start_time,
+	    self.stats.get('rpc_wait', 0.0),
+	    client = self.client_address[0])
+
+    def log_message(self, format, *args):
+	"""Queue a free-form message (errors, mostly)."""
+	self.server.access_log.message(format % args,
+	    client = self.client_address[0])
+
+class AnuServer(simple_server.WSGIServer):
+    """WSGI server which can hand connections over to WebSocket sessions.
+
+    Connections which have been handed over aren't closed at the end of
+    the request: they belong to their session thread from then on.
+    """
+    def __init__(self, addr, handler_class):
+	"""Bind the server. Arguments are as for WSGIServer."""
+	self.sessions = []
+	simple_server.WSGIServer.__init__(self, addr, handler_class)
+
+    def start_session(self, sock, handler):
+	"""Start an awsocket.Session serving the given socket."""
+	self.sessions = [s for s in self.sessions if s.is_alive()]
+	s = awsocket.Session(sock, handler)
+	self.sessions.append(s)
+	s.start()
+
+    def shutdown_request(self, request):
+	"""Close a connection, unless it belongs to a session."""
+	for s in self.sessions:
+	    if s.sock is request:
+		return
+	simple_server.WSGIServer.shutdown_request(self, request)
+
+    def close_sessions(self):
+	"""Shut down all WebSocket sessions."""
+	for s in self.sessions:
+	    s.close()
+	self.sessions = []
+
+class ServerThread(threading.Thread):
+    """WSGI server thread.
+
+    This object provides thread which runs the WSGI reference server. It
+    also implements a synchronized shutdown.
+    """
+    def __init__(self, handler, addr, log):
+	"""Initialize a server.
+
+	You must supply a handler function object, a (address, port)
+	tuple and an awlog.AccessLog. The server port will be bound, but
+	neither the server thread nor the log writer will start until
+	you call the start() method.
+	"""
+	threading.Thread.__init__(self)
+	# Don't inherit the daemon flag from a StartupThread
+	self.daemon = False
+	self.app = handler
+	self.log = log
+	self.server = AnuServer(addr, NoDNSHandler)
+	self.server.access_log = log
+	self.server.set_app(handler)
+
+    def run(self):
+	"""Worker function.
+
+	Do not call this method -- it's what runs in the created thread.
+	"""
+	self.log.start()
+	self.server.serve_forever()
+	self.server.server_close()
+
+    def shutdown(self):
+	"""Synchronous shutdown.
+
+	Shut down a running server thread. The method doesn't return
+	until after the thread is terminated. The server's resources are
+	freed and any WebSocket sessions are disconnected. Queued log
+	records are written out in the background.
+	"""
+	self.server.shutdown()
+	self.join()
+	self.server.close_sessions()
+	self.log.close()
+
+def start_server(totem_obj, cfg):
+    """Construct and start a web server thread.
+
+    You must supply a reference to the Totem object and a configuration
+    dictionary (see awconfig.read_config()). The running ServerThread is
+    returned. Its app attribute is the AnuApp, whose prefetch() method
+    can be used to warm up caches afterwards.
+    """
+    app = anuweb.AnuApp(totem_obj, cfg)
+    log = awlog.AccessLog(cfg['log_path'],
+			  cfg['log_sample_percent'])
+    server = ServerThread(app, ('0.0.0.0', cfg['server_port']), log)
+    server.start()
+    return server
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+# Anuweb - Totem web interface
+# Copyright (C) 2013 Daniel Beer
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import socket
+import struct
+import base64
+import hashlib
+import threading
+import urlparse
+
+# Magic value used to compute Sec-WebSocket-Accept (RFC 6455, 1.3)
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED = 1003
+CLOSE_BAD_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+class ProtocolError(Exception):
+    """A WebSocket peer broke the rules.
+
+    The code attribute gives the close status to report to the peer.
+    """
+    def __init__(self, code, reason):
+	Exception.__init__(self, reason)
+	self.code = code
+	self.reason = reason
+
+def handshake_key(command, headers):
+    """Validate a WebSocket opening handshake.
+
+    Given the request method and a mimetools.Message of request
+    headers, return the client's Sec-WebSocket-Key, or None if this
+    isn't a valid version 13 upgrade request.
+    """
+    if command != 'GET':
+	return None
+    if headers.getheader('upgrade', '').lower() != 'websocket':
+	return None
+
+    conn = [c.strip().lower() for c in
+	    headers.getheader('connection', '').split(',')]
+    if 'upgrade' not in conn:
+	return None
+    if headers.getheader('sec-websocket-version', '').strip() != '13':
+	return None
+
+    return headers.getheader('sec-websocket-key')
+
+def origin_allowed(headers):
+    """Check the Origin of a WebSocket opening handshake.
+
+    Browsers send the Origin header with every WebSocket request, and
+    will connect on behalf of any web page. Only pages served from the
+    host the request was addressed to are allowed. Requests without an
+    Origin header don't come from a browser, and are allowed.
+    """
+    origin = headers.getheader('origin')
+    if origin is None:
+	return True
+
+    host = headers.getheader('host', '').strip().lower()
+    return urlparse.urlparse(origin.strip()).netloc.lower() == host
+
+def handshake_response(key):
+    """Build the server's response to a valid opening handshake."""
+    accept = base64.b64encode(hashlib.sha1(key.strip() + GUID).digest())
+    return ('HTTP/1.1 101 Switching Protocols\r\n'
+	    'Upgrade: websocket\r\n'
+	    'Connection: Upgrade\r\n'
+	    'Sec-WebSocket-Accept: %s\r\n'
+	    '\r\n' % accept)
+
+class WebSocket:
+    """Server end of a WebSocket connection.
+
+    This object implements RFC 6455 framing over a connected socket,
+    once the opening handshake has been completed. Only text messages
+    are supported. Pings are answered automatically, and fragmented
+    messages are reassembled.
+    """
+    def __init__(self, sock, max_size = 65536):
+	"""Wrap a connected socket.
+
+	Messages larger than max_size bytes are refused.
+	"""
+	self.sock = sock
+	self.max_size = max_size
+	self.closed = False
+
+    def read_exact(self, n):
+	"""Read exactly n bytes from the socket.
+
+	Raises EOFError if the connection is closed first.
+	"""
+	chunks = []
+	while n > 0:
+	    data = self.sock.recv(n)
+	    if not data:
+		raise EOFError
+	    chunks.append(data)
+	    n -= len(data)
+	return ''.join(chunks)
+
+    def read_frame(self):
+	"""Read and unmask a single frame.
+
+	Returns a (fin, opcode, payload) tuple.
+	"""
+	b0, b1 = struct.unpack('!BB', self.read_exact(2))
+	fin = bool(b0 & 0x80)
+	opcode = b0 & 0x0f
+	length = b1 & 0x7f
+
+	if b0 & 0x70:
+	    raise ProtocolError(CLOSE_PROTOCOL_ERROR, 'reserved bits set')
+	if not b1 & 0x80:
+	    raise ProtocolError(CLOSE_PROTOCOL_ERROR, 'unmasked frame')
+
+	if length == 126:
+	    length = struct.unpack('!H', self.read_exact(2))[0]
+	elif length == 127:
+	    length = struct.unpack('!Q', self.read_exact(8))[0]
+
+	if opcode & 0x8:
+	    if not fin or length > 125:
+		raise ProtocolError(CLOSE_PROTOCOL_ERROR,
+				    'bad control frame')
+	elif length > self.max_size:
+	    raise ProtocolError(CLOSE_TOO_BIG, 'message too big')
+
+	mask = bytearray(self.read_exact(4))
+	payload = bytearray(self.read_exact(length))
+	for i in xrange(length):
+	    payload[i] ^= mask[i & 3]
+
+	return (fin, opcode, str(payload))
+
+    def write_frame(self, opcode, payload):
+	"""Send a single, unfragmented, unmasked frame."""
+	length = len(payload)
+	if length < 126:
+	    header = struct.pack('!BB', 0x80 | opcode, length)
+	elif length < 65536:
+	    header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+	else:
+	    header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+	self.sock.sendall(header + payload)
+
+    def recv(self):
+	"""Receive a text message.
+
+	Returns the message as a UTF-8 encoded string, or None if the
+	connection was closed (either by the peer, or by a
+	ProtocolError).
+	"""
+	parts = []
+	size = 0
+
+	while not self.closed:
+	    try:
+		fin, opcode, payload = self.read_frame()
+	    except ProtocolError as e:
+		self.close(e.code, e.reason)
+		return None
+	    except EOFError:
+		self.closed = True
+		return None
+
+	    if opcode == OP_PING:
+		self.write_frame(OP_PONG, payload)
+		continue
+	    if opcode == OP_PONG:
+		continue
+	    if opcode == OP_CLOSE:
+		self.close(CLOSE_NORMAL)
+		return None
+
+	    if opcode == OP_BINARY:
+		self.close(CLOSE_UNSUPPORTED, 'text only')
+		return None
+	    if opcode == OP_TEXT and parts:
+		self.close(CLOSE_PROTOCOL_ERROR, 'expected continuation')
+		return None
+	    if opcode == OP_CONTINUATION and not parts:
+		self.close(CLOSE_PROTOCOL_ERROR, 'unexpected continuation')
+		return None
+	    if opcode not in (OP_TEXT, OP_CONTINUATION):
+		self.close(CLOSE_PROTOCOL_ERROR, 'unknown opcode')
+		return None
+
+	    size += len(payload)
+	    if size > self.max_size:
+		self.close(CLOSE_TOO_BIG, 'message too big')
+		return None
+
+	    parts.append(payload)
+	    if fin:
+		msg = ''.join(parts)
+		try:
+		    msg.decode('utf-8')
+		except UnicodeDecodeError:
+		    self.close(CLOSE_BAD_DATA, 'invalid UTF-8')
+		    return None
+		return msg
+
+	return None
+
+    def send(self, text):
+	"""Send a text message (a UTF-8 encoded string)."""
+	self.write_frame(OP_TEXT, text)
+
+    def close(self, code = CLOSE_NORMAL, reason = ''):
+	"""Send a close frame, if we haven't already."""
+	if self.closed:
+	    return
+
+	self.closed = True
+	try:
+	    self.write_frame(OP_CLOSE, struct.pack('!H', code) + reason)
+	except socket.error:
+	    pass
+
+class Session(threading.Thread):
+    """WebSocket session thread.
+
+    Each accepted connection is served by its own thread. Every text
+    message received is passed to a handler function object, and the
+    handler's return value (if not None) is sent back as a reply.
+    """
+    def __init__(self, sock, handler):
+	"""Initialize a session.
+
+	You must supply a socket on which the opening handshake has
+	already been completed, and a handler function object. The
+	thread won't start until you call the start() method.
+	"""
+	threading.Thread.__init__(self)
+	self.daemon = True
+	self.sock = sock
+	self.handler = handler
+
+    def run(self):
+	"""Worker function.
+
+	Do not call this method -- it's what runs in the created thread.
+	"""
+	ws = WebSocket(self.sock)
+	try:
+	    while True:
+		msg = ws.recv()
+		if msg is None:
+		    break
+
+		reply = self.handler(msg)
+		if reply is not None:
+		    ws.send(reply)
+	except socket.error:
+	    pass
+	finally:
+	    self.sock.close()
+
+    def close(self):
+	"""Asynchronous shutdown.
+
+	Shut down the connection, which will cause the thread to exit
+	once it has finished handling the current message. The thread
+	isn't joined, since that message might be waiting on an RPC to
+	the main loop we're being called from.
+	"""
+	try:
+	    self.sock.shutdown(socket.SHUT_RDWR)
+	except socket.error:
+	    pass